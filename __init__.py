@@ -1,7 +1,9 @@
 import os
+import queue
+import atexit
 import logging
 from dotenv import load_dotenv
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 
 load_dotenv()
@@ -35,8 +37,13 @@ def get_logger(name: str) -> logging.getLogger:
     logger: logging.getLogger = logging.getLogger(name)
     if logger.hasHandlers():
         logger.handlers.clear()
-    logger.addHandler(get_file_handler(name))
-    logger.addHandler(get_stream_handler())
+    # Запись в файл и в консоль выполняется в отдельном потоке, логгер только кладет записи в очередь
+    log_queue: queue.Queue = queue.Queue(-1)
+    listener: QueueListener = QueueListener(log_queue, get_file_handler(name), get_stream_handler(),
+                                            respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
     logger.setLevel(logging.INFO)
     return logger
 
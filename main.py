@@ -6,6 +6,8 @@ from __init__ import *
 from clickhouse_connect import get_client
 from clickhouse_connect.driver import Client
 from datetime import datetime, timezone, date
+from typing import Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 pd.set_option('display.max_columns', 30)
@@ -16,6 +18,31 @@ warnings.simplefilter('ignore')
 logger: logging.getLogger = get_logger(os.path.basename(__file__).replace(".py", "_") + str(datetime.now().date()))
 
 table = 'new_route'
+stage_table = 'new_route_stage'
+
+columns = ['type_of_transportation', 'text_route_number', 'text_route_number_count', 'route_min_date', 'route_month',
+           'route_year', 'departure_station_code_of_rf', 'departure_station_of_the_rf', 'departure_region',
+           'destination_station_code_of_rf', 'rf_destination_station', 'destination_region',
+           'payer_of_the_railway_tariff_unified', 'shipper_okpo', 'shipper_by_puzt', 'consignee_okpo',
+           'consignee_by_puzt', 'teu']
+
+# Сортируем по дате, а маршруты за одну дату - по номеру маршрута
+select_new_routes = f"SELECT {', '.join(columns)} FROM new_route_rf " \
+                    "ORDER BY toDate(route_min_date), toUInt32OrZero(extract(text_route_number, '[0-9]+$'))"
+
+row_columns = ['departure_station_code_of_rf','destination_station_code_of_rf','payer_of_the_railway_tariff_unified',
+               'shipper_okpo','consignee_okpo']
+# Колонки со старыми значениями для каждой колонки из row_columns
+old_value_columns = ['departure_station_of_the_rf', 'rf_destination_station', 'payer_of_the_railway_tariff_unified',
+                     'shipper_by_puzt', 'consignee_by_puzt']
+
+# Количество маршрутов, для которых матрица сравнения строится за один раз (в каждом потоке)
+chunk_size = 256
+# Количество потоков для сравнения маршрутов: каждый поток держит в памяти свои матрицы сравнения,
+# а os.cpu_count() в Docker возвращает ядра хоста, а не лимит контейнера
+max_workers = min(4, os.cpu_count() or 1)
+# Количество строк в одной вставке в ClickHouse
+insert_block_size = 65536
 
 utc_current_datetime_start = datetime.now(timezone.utc)
 
@@ -26,153 +53,186 @@ def serialize_datetime(obj):
     raise TypeError("Type not serializable")
 
 
-def connect_to_db() -> Client:
+def connect_to_db() -> Tuple[Client, pd.DataFrame]:
     """
     Connecting to clickhouse.
-    :return: Client ClickHouse.
+    :return: Client ClickHouse and DataFrame with new routes.
     """
     try:
         client: Client = get_client(host=get_my_env_var('HOST'), database=get_my_env_var('DATABASE'),
-                                    username=get_my_env_var('USERNAME_DB'), password=get_my_env_var('PASSWORD'))
-        client.query("SET allow_experimental_lightweight_delete=1")
+                                    username=get_my_env_var('USERNAME_DB'), password=get_my_env_var('PASSWORD'),
+                                    settings={'async_insert': 0})
         logger.info("Success connect to clickhouse")
-        new_routes = client.query("SELECT * FROM new_route_rf")
+        new_routes: pd.DataFrame = client.query_df(select_new_routes, settings={'max_block_size': 131072})
         # Чтобы проверить, есть ли данные. Так как переменная образуется, но внутри нее могут быть ошибки.
-        print(new_routes.result_rows[0])
+        print(new_routes.iloc[0])
     except Exception as ex_connect:
         logger.error(f"Error connection to db {ex_connect}. Type error is {type(ex_connect)}.")
         sys.exit(1)
     return client, new_routes
 
 
-client, new_routes = connect_to_db()
-
-list_new_routes = []
-for tuple_row in new_routes.result_rows:
-    dict_new_routes = {}
-    for column, row in zip(new_routes.column_names, tuple_row):
-        dict_new_routes[column] = row
-    list_new_routes.append(dict_new_routes)
-
-client.query(f"DELETE FROM {table} WHERE uuid is not NULL")
-logger.info("Successfully deleted new_route data")
+def get_column_type_names(client: Client, table_name: str) -> Dict[str, str]:
+    """
+    Getting ClickHouse types of table columns, so that the driver doesn't request them on insert.
+    :param client: Client ClickHouse.
+    :param table_name: Table name.
+    :return: Dictionary with column names and their types.
+    """
+    return {row[0]: row[1] for row in client.query(f"DESCRIBE TABLE {table_name}").result_rows}
 
-df = pd.DataFrame(list_new_routes)
 
-df[[
-    'text_route_number_count',
-    'route_month',
-    'route_year',
-    'teu'
-]] = df[[
-    'text_route_number_count',
-    'route_month',
-    'route_year',
-    'teu'
-]].astype('Int64')
+def find_old_routes(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Search of the previous route for each route of the working dataset.
+    Routes are compared by row_columns with all earlier routes of the same type of transportation,
+    chunks of chunk_size routes are compared in parallel threads.
+    :param data: Working dataset sorted by route_min_date.
+    :return: DataFrame with columns text_route_number, old_text_route_number, changed_field.
+    """
+    # Значения полей заменяем целочисленными кодами, пустые значения получают код -1
+    keys = np.column_stack([pd.factorize(data[col])[0] for col in row_columns]).astype(np.int32)
+    dates = data['route_min_date'].to_numpy()
+    old_index = np.full(len(data), -1)
+    changed_mask = np.zeros(len(data), dtype=np.uint8)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tasks = []
+        for group in data.groupby('type_of_transportation', sort=False, dropna=False).indices.values():
+            group_dates = dates[group]
+            for start in range(0, len(group), chunk_size):
+                rows = group[start:start + chunk_size]
+                # Маршруты отсортированы по дате, поэтому предыдущими могут быть только маршруты с датой раньше,
+                # чем у последнего маршрута в чанке, остальные даже не сравниваем
+                candidates = group[:np.searchsorted(group_dates, dates[rows[-1]], side='left')]
+                if len(candidates):
+                    tasks.append(executor.submit(match_routes, keys, dates, rows, candidates))
+        # Чанки не пересекаются по строкам, поэтому результаты можно записывать в любом порядке
+        for task in as_completed(tasks):
+            rows, old_rows, masks = task.result()
+            old_index[rows] = old_rows
+            changed_mask[rows] = masks
+
+    # Названия измененных полей для каждой битовой маски
+    changed_fields = np.array([', '.join(col for bit, col in enumerate(row_columns) if mask >> bit & 1)
+                               for mask in range(1 << len(row_columns))], dtype=object)
+    found = np.flatnonzero(old_index >= 0)
+    return pd.DataFrame({
+        'text_route_number': data['text_route_number'].to_numpy()[found],
+        'old_text_route_number': data['text_route_number'].to_numpy()[old_index[found]],
+        'changed_field': changed_fields[changed_mask[found]]
+    })
+
+
+def match_routes(keys: np.ndarray, dates: np.ndarray, rows: np.ndarray,
+                 candidates: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Search of the previous route for a chunk of routes among candidates.
+    :param keys: Codes of row_columns for all routes, -1 for empty values.
+    :param dates: Dates of all routes.
+    :param rows: Positions of the chunk routes.
+    :param candidates: Positions of the possible previous routes in ascending order.
+    :return: Positions of routes with the previous route found, positions of their previous routes
+    and bitmasks of the changed fields.
+    """
+    is_earlier = dates[rows][:, None] > dates[candidates][None, :]
+    # Поле не изменилось, если значения равны или текущее значение пустое (так его считал DataFrame.compare)
+    same = (keys[rows][:, None, :] == keys[candidates][None, :, :]) | (keys[rows] < 0)[:, None, :]
+    priority = np.where(is_earlier, get_priority(same), 0)
+    # Для каждого маршрута берем самый поздний из предыдущих маршрутов с наивысшим приоритетом
+    score = np.where(priority > 0, (len(row_columns) - priority) * len(candidates) + np.arange(len(candidates)), -1)
+    best = score.argmax(axis=1)
+    found = np.flatnonzero(score[np.arange(len(rows)), best] >= 0)
+    field_bits = 1 << np.arange(len(row_columns), dtype=np.uint8)
+    return rows[found], candidates[best[found]], (~same[found, best[found]]) @ field_bits
+
+
+def get_priority(same: np.ndarray) -> np.ndarray:
+    """
+    Priority of the previous route by the matrix of unchanged fields (the last axis is row_columns).
+    Routes with the same stations go first, then routes with one changed station;
+    in both cases one changed field is preferred to two. 0 means that the route doesn't fit.
+    :param same: Boolean matrix of unchanged fields.
+    :return: Matrix of priorities from 0 to 4.
+    """
+    matches = same.sum(axis=-1)
+    stations_same = same[..., 0] & same[..., 1]
+    one_station_diff = same[..., 0] ^ same[..., 1]
+    return np.select(
+        [stations_same & (matches == 4), stations_same & (matches == 3),
+         one_station_diff & (matches == 4), one_station_diff & (matches == 3)],
+        [1, 2, 3, 4],
+        default=0
+    )
+
+
+client, df = connect_to_db()
+
+df = df.astype({
+    'text_route_number_count': 'Int64',
+    'route_month': 'Int64',
+    'route_year': 'Int64',
+    'teu': 'Int64'
+})
 
 df.info()
 
 # формируем рабочий датасет
-df['route_min_date'] = pd.to_datetime(df['route_min_date'], errors='coerce').dt.date
-data = df.query('text_route_number_count == 1').drop(columns=['text_route_number_count', 'route_month', 'route_year', 'departure_station_of_the_rf', 'departure_region', 'rf_destination_station', 'destination_region', 'shipper_by_puzt', 'consignee_by_puzt', 'teu']).sort_values(by='route_min_date').reset_index(drop=True)
+# Строки уже отсортированы по route_min_date в запросе, фильтр порядок не меняет:
+# find_old_routes ищет предыдущие маршруты через searchsorted и рассчитывает на эту сортировку
+# Для сравнения дата остается в datetime64 (в местном времени, без часового пояса),
+# а в ClickHouse пишем объекты date, как и раньше
+route_min_date = pd.to_datetime(df['route_min_date'], errors='coerce').dt.tz_localize(None).dt.normalize()
+df['route_min_date'] = route_min_date.dt.date
+is_single_route = (df['text_route_number_count'] == 1).fillna(False).to_numpy(dtype=bool)
+data = df.loc[is_single_route, ['type_of_transportation', 'text_route_number', 'route_min_date'] + row_columns]\
+    .reset_index(drop=True)
+data['route_min_date'] = route_min_date.to_numpy()[is_single_route]
 
 # формируем датасет для сохранения данных
-data_old = data.drop(columns=['type_of_transportation','route_min_date', 'departure_station_code_of_rf','destination_station_code_of_rf','payer_of_the_railway_tariff_unified','shipper_okpo','consignee_okpo'])
-data_old['old_text_route_number'] = None
-data_old['changed_field'] = None
+data_old = data[['text_route_number']].merge(find_old_routes(data), on='text_route_number', how='left')
 data_old['old_value_field'] = None
-data_old = data_old.set_index('text_route_number', drop=False)
-
-
-row_columns = ['departure_station_code_of_rf','destination_station_code_of_rf','payer_of_the_railway_tariff_unified',
-               'shipper_okpo','consignee_okpo']
-for u in data.index:
-    for i in reversed(range(u)):
-        cout_true = 0
-        seft = data.loc[u].compare(data.loc[i], keep_shape=True).T
-        if (pd.isnull(seft['type_of_transportation']['self'])) and (pd.notnull(seft['route_min_date']['self'])):
-            if (pd.isnull(seft['departure_station_code_of_rf']['self'])) and (pd.isnull(seft['destination_station_code_of_rf']['self'])):
-                cout_true = seft.T['self'].isnull().sum()
-        if cout_true == 5:
-            for row_col in row_columns:
-                if pd.notnull(seft[row_col]['self']):
-                    data_old['old_text_route_number'][seft['text_route_number']['self']] = seft['text_route_number']['other']
-                    data_old['changed_field'][seft['text_route_number']['self']] = row_col
-            break
-    else:
-        for i in reversed(range(u)):
-            cout_true = 0
-            seft = data.loc[u].compare(data.loc[i], keep_shape=True).T
-            if (pd.isnull(seft['type_of_transportation']['self'])) and (pd.notnull(seft['route_min_date']['self'])):
-                if (pd.isnull(seft['departure_station_code_of_rf']['self'])) and (pd.isnull(seft['destination_station_code_of_rf']['self'])):
-                    cout_true = seft.T['self'].isnull().sum()
-            if cout_true == 4:
-                changed_field = ''
-                for row_col in row_columns:
-                    if pd.notnull(seft[row_col]['self']):
-                        changed_field += str(row_col) + ', '
-                data_old['old_text_route_number'][seft['text_route_number']['self']] = seft['text_route_number']['other']
-                data_old['changed_field'][seft['text_route_number']['self']] = changed_field[0 : -2]
-                break
-        else:
-            for i in reversed(range(u)):
-                cout_true = 0
-                seft = data.loc[u].compare(data.loc[i], keep_shape=True).T
-                if (pd.isnull(seft['type_of_transportation']['self'])) and (pd.notnull(seft['route_min_date']['self'])):
-                    if (pd.notnull(seft['departure_station_code_of_rf']['self'])) or (pd.notnull(seft['destination_station_code_of_rf']['self'])):
-                        cout_true = seft.T['self'].isnull().sum()
-                if cout_true == 5:
-                    for row_col in row_columns:
-                        if pd.notnull(seft[row_col]['self']):
-                            data_old['old_text_route_number'][seft['text_route_number']['self']] = seft['text_route_number']['other']
-                            data_old['changed_field'][seft['text_route_number']['self']] = row_col
-                    break
-            else:
-                for i in reversed(range(u)):
-                    cout_true = 0
-                    seft = data.loc[u].compare(data.loc[i], keep_shape=True).T
-                    if (pd.isnull(seft['type_of_transportation']['self'])) and (pd.notnull(seft['route_min_date']['self'])):
-                        if ((pd.notnull(seft['departure_station_code_of_rf']['self'])) and not (pd.notnull(seft['destination_station_code_of_rf']['self']))) or (not (pd.notnull(seft['departure_station_code_of_rf']['self'])) and (pd.notnull(seft['destination_station_code_of_rf']['self']))):
-                            cout_true = seft.T['self'].isnull().sum()
-                    if cout_true == 4:
-                        changed_field = ''
-                        for row_col in row_columns:
-                            if pd.notnull(seft[row_col]['self']):
-                                changed_field += str(row_col) + ', '
-                        data_old['old_text_route_number'][seft['text_route_number']['self']] = seft['text_route_number']['other']
-                        data_old['changed_field'][seft['text_route_number']['self']] = changed_field[0 : -2]
-                        break
-data_old = data_old.reset_index(drop=True)
 df = df.merge(data_old, on='text_route_number', how='left')
 
 
-df['category_route'] = np.nan
-for u in df.index:
-    old_value_field = ''
-    if pd.notnull(df['old_text_route_number'][u]):
-        seft = df.loc[u].compare(df.loc[int(str(df.index[(df['text_route_number'] == df['old_text_route_number'].loc[u]) & (df['text_route_number_count'] == 1)].tolist())[1 : -1])], keep_shape=True).T
-        if pd.notnull(seft['departure_station_code_of_rf']['self']):
-            old_value_field += str(seft['departure_station_of_the_rf']['other']) + ', '
-        if pd.notnull(seft['destination_station_code_of_rf']['self']):
-            old_value_field += str(seft['rf_destination_station']['other']) + ', '
-        if pd.notnull(seft['payer_of_the_railway_tariff_unified']['self']):
-            old_value_field += str(seft['payer_of_the_railway_tariff_unified']['other']) + ', '
-        if pd.notnull(seft['shipper_okpo']['self']):
-            old_value_field += str(seft['shipper_by_puzt']['other']) + ', '
-        if pd.notnull(seft['consignee_okpo']['self']):
-            old_value_field += str(seft['consignee_by_puzt']['other']) + ', '
-    df['old_value_field'][u] = old_value_field[0 : -2]
-    if (str(df['changed_field'][u]).find('departure_station_code_of_rf') != -1) or (str(df['changed_field'][u]).find('destination_station_code_of_rf') != -1) or pd.isnull(df['old_text_route_number'][u]):
-        df['category_route'][u] = 'Новый маршрут'
-    else:
-        df['category_route'][u] = 'Изменение в маршруте'
-
-
-df = df.replace({np.nan: None, "NaT": None})
+keys = df[row_columns].to_numpy(dtype=object)
+keys_isnull = df[row_columns].isna().to_numpy()
+old_values = df[old_value_columns].to_numpy(dtype=object)
+# Позиция предыдущего маршрута в df (merge с how='left' сохраняет порядок строк df)
+route_positions = pd.Series(np.flatnonzero(is_single_route), index=df.loc[is_single_route, 'text_route_number'])
+old_positions = df['old_text_route_number'].map(route_positions)
+rows = np.flatnonzero(old_positions.notna().to_numpy())
+old_rows = old_positions.to_numpy()[rows].astype(int)
+# Старые значения берем только для изменившихся полей
+is_changed = (keys[rows] != keys[old_rows]) & ~keys_isnull[rows]
+old_value_fields = np.full(len(df), '', dtype=object)
+old_value_fields[rows] = [', '.join(map(str, values[changed]))
+                          for values, changed in zip(old_values[old_rows], is_changed)]
+df['old_value_field'] = old_value_fields
+
+# Маршрут новый, если предыдущего нет или у него изменилась одна из станций
+changed_field = df['changed_field'].fillna('')
+is_new_route = df['old_text_route_number'].isna() \
+    | changed_field.str.contains('departure_station_code_of_rf', regex=False) \
+    | changed_field.str.contains('destination_station_code_of_rf', regex=False)
+df['category_route'] = np.where(is_new_route, 'Новый маршрут', 'Изменение в маршруте')
+logger.info(f"Found previous routes for {len(rows)} routes, {int((~is_new_route).sum())} of them are marked as changed")
+
+# Пустые значения заменяем на None только в object-колонках, числовые колонки драйвер обрабатывает сам
+object_columns = df.select_dtypes(include='object').columns
+df[object_columns] = df[object_columns].where(df[object_columns].notna(), None)
 
 try:
-    client.insert_df(table=table, df=df)
+    # Загружаем данные в промежуточную таблицу и атомарно меняем ее местами с основной
+    # Промежуточную таблицу пересоздаем, чтобы у нее всегда была текущая схема основной
+    client.command(f"DROP TABLE IF EXISTS {stage_table}")
+    client.command(f"CREATE TABLE {stage_table} AS {table}")
+    column_type_names: Dict[str, str] = get_column_type_names(client, stage_table)
+    insert_type_names: list = [column_type_names[column] for column in df.columns]
+    # Вставляем блоками, чтобы драйвер не конвертировал весь DataFrame за один раз
+    for start in range(0, len(df), insert_block_size):
+        client.insert_df(table=stage_table, df=df.iloc[start:start + insert_block_size],
+                         column_names=list(df.columns), column_type_names=insert_type_names)
+    client.command(f"EXCHANGE TABLES {table} AND {stage_table}")
     logger.info("Success insert to clickhouse")
 except Exception as ex_insert:
     logger.error(f"Error insert to db {ex_insert}. Type error is {type(ex_insert)}.")